@@ -1,14 +1,66 @@
-import datetime
+import asyncio
 import logging.config
+import time
 from environs import Env
 from seller import download_stock
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from seller import divide, price_conversion
+from seller import (
+    is_read_timeout,
+    json_dumps,
+    json_loads,
+    MAX_CONCURRENT_REQUESTS,
+    price_column_conversion,
+    RETRIES,
+    select_remnants,
+    send_batches,
+    stock_column_conversion,
+    TIMEOUT,
+)
 
 logger = logging.getLogger(__file__)
 
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=RETRIES))
+ENDPOINT_URL = "https://api.partner.market.yandex.ru/"
+HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Host": "api.partner.market.yandex.ru",
+}
+OFFER_IDS_TTL = 300
+_offer_ids_cache = {}
+
+
+def request_json(method, path, access_token, params=None, payload=None):
+    """Выполняет запрос к API Yandex.Market и разбирает JSON-ответ.
+
+    Args:
+    method(str): HTTP-метод запроса ('GET', 'PUT', 'POST')
+    path(str): Путь метода API относительно `ENDPOINT_URL`
+    access_token(str): Токен аутентификации компании(продавца)
+    params(dict): Параметры строки запроса
+    payload(dict): Тело запроса, отправляется в формате JSON
+
+    Returns:
+    dict: Разобранный ответ сервера
+
+    Exceptions:
+    HTTPError: Возникает, если сервер вернул ошибку (код статуса >= 400)"""
+    headers = {**HEADERS, "Authorization": f"Bearer {access_token}"}
+    response = _session.request(
+        method,
+        ENDPOINT_URL + path,
+        headers=headers,
+        params=params,
+        data=None if payload is None else json_dumps(payload),
+        timeout=TIMEOUT,
+    )
+    response.raise_for_status()
+    return json_loads(response.content)
+
 
 def get_product_list(page, campaign_id, access_token): 
     """ Запрашивает список товаров с сайта Yandex.Market 
@@ -27,21 +79,12 @@ def get_product_list(page, campaign_id, access_token):
     Exceptions: 
     HTTPError: Возникает, если сервер вернул ошибку (код статуса >= 400) 
     KeyError: Возникает пре отсутствии поля 'result' """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    path = f"campaigns/{campaign_id}/offer-mapping-entries"
+    response_object = request_json("GET", path, access_token, params=payload)
     return response_object.get("result")
 
 
@@ -61,19 +104,9 @@ def update_stocks(stocks, campaign_id, access_token):
     
     Пример:
     update_stocks(stocks, campaign_id, access_token) {'result': 'Остатки успешно обновлены.'}"""
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    path = f"campaigns/{campaign_id}/offers/stocks"
+    return request_json("PUT", path, access_token, payload=payload)
 
 
 def update_price(prices, campaign_id, access_token): 
@@ -92,24 +125,15 @@ def update_price(prices, campaign_id, access_token):
     
     Пример: 
     update_price(prices, campaign_id, access_token){'result': 'Цены успешно обновлены.'} """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    path = f"campaigns/{campaign_id}/offer-prices/updates"
+    return request_json("POST", path, access_token, payload=payload)
 
 
 def get_offer_ids(campaign_id, market_token):
     """Запрашивает артикулы всех товаров продавца с сайта Yandex.Market через API, и формирует список артикулов
-    
+    Результат кэшируется для пары идентификатор/токен на `OFFER_IDS_TTL` секунд, 
+    поэтому повторные вызовы (для остатков и для цен) не повторяют пагинацию.
     
     Agrs: 
     campaign_id(str): Клиентский идентификатор для получения доступа к своему магазину на сайте Yandex.Market
@@ -123,18 +147,23 @@ def get_offer_ids(campaign_id, market_token):
     
     Пример: 
     offer_ids = ['dfwd1254','zcsefr321'...] """
+    cache_key = (campaign_id, market_token)
+    cached = _offer_ids_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < OFFER_IDS_TTL:
+        return list(cached[1])
     page = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        offer_ids.extend(
+            product.get("offer").get("shopSku")
+            for product in some_prod.get("offerMappingEntries")
+        )
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
-    return offer_ids
+    _offer_ids_cache[cache_key] = (time.monotonic(), offer_ids)
+    return list(offer_ids)
 
 
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
@@ -146,7 +175,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     актикулов, не встречающихся в watch_remnants выставляется остаток 0. 
     
     Agrs: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
     offer_ids(List[str]): Список артикулов товаров, зарегистрированных на сайте Yandex.Market .
     warehouse_id(str): Идентификатор склада, к которому привязаны остатки.
 
@@ -157,50 +186,33 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     Exceptions: 
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных.   
     ValueError: Если какая-либо запись в `watch_remnants` содержит недопустимые или неполные данные.
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы ('Код' или 'Количество')
     
     Пример: 
     stocks =  [{'sku': 'Asd', 'warehouseId': 'VB21', items:[{'count': 2, 'type': 'FIT', 'updatedAt': 12.03.2024}]}... """
     # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
+    remnants = select_remnants(watch_remnants, offer_ids)
+    return _stocks_from_remnants(remnants, offer_ids, warehouse_id)
+
+
+def _stocks_from_remnants(remnants, offer_ids, warehouse_id):
+    """Формирует остатки из уже отобранных `select_remnants` строк (см. `create_stocks`)."""
+    date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    item = {"type": "FIT", "updatedAt": date}
+    remnants = remnants.drop_duplicates("Код")
+    counts = stock_column_conversion(remnants["Количество"])
+    matched = remnants["Код"].tolist()
+    stocks = [
+        {"sku": code, "warehouseId": warehouse_id, "items": [{"count": stock, **item}]}
+        for code, stock in zip(matched, counts.tolist())
+    ]
+    matched = set(matched)
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
+    stocks.extend(
+        {"sku": offer_id, "warehouseId": warehouse_id, "items": [{"count": 0, **item}]}
+        for offer_id in offer_ids
+        if offer_id not in matched
+    )
     return stocks
 
 
@@ -209,10 +221,10 @@ def create_prices(watch_remnants, offer_ids):
     из переменной `offer_ids`. Проходится по списку товаров(`watch_remnants`), фильтруя только те 
     товары, чей артикул указан в переменой (`offer_ids`). Создается переменная (`price`) которая 
     содержит информацию о цене, валюте. Переводит оригинальную цену в нужный формат и округляется до целого числа в функции 
-    (`price_conversion`) 
+    (`price_column_conversion`) 
     
     Args: 
-    watch_remnants(List[dict]):  Список словарей, каждый из которых содержит информацию о конкретном товаре
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
     offer_ids(List[str]): Список артикулов товаров, зарегистрированных на Yandex.Market.
     
     Returns:
@@ -221,18 +233,25 @@ def create_prices(watch_remnants, offer_ids):
     Exceptions: 
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных.   
     ValueError: Если какая-либо запись в `watch_remnants` содержит недопустимые или неполные данные. 
-    KeyError: Появится, если в словаре из `watch_remnants` отсутствуют обязательные поля ('Код' или 'Цена')
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы ('Код' или 'Цена')
     
     Пример: 
     prices =  [ {'id': 'T123', 'price': {'value': 1235, 'currencyId': 'RUR'}}""" 
+    remnants = select_remnants(watch_remnants, offer_ids)
+    return _prices_from_remnants(remnants)
+
+
+def _prices_from_remnants(remnants):
+    """Формирует цены из уже отобранных `select_remnants` строк (см. `create_prices`)."""
+    converted = price_column_conversion(remnants["Цена"])
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
+    for code, price in zip(remnants["Код"].tolist(), converted.astype(int).tolist()):
+        prices.append(
+            {
+                "id": code,
                 # "feed": {"id": 0},
                 "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
+                    "value": price,
                     # "discountBase": 0,
                     "currencyId": "RUR",
                     # "vat": 0,
@@ -240,16 +259,38 @@ def create_prices(watch_remnants, offer_ids):
                 # "marketSku": 0,
                 # "shopSku": "string",
             }
-            prices.append(price)
+        )
     return prices
 
 
+def create_prices_and_stocks(watch_remnants, offer_ids, warehouse_id):
+    """Создает цены и остатки за один отбор строк из таблицы остатков. Таблица целиком 
+    фильтруется по `offer_ids` один раз, после чего цены и остатки формируются 
+    только из отобранных строк.
+
+    Args:
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
+    offer_ids(List[str]): Список артикулов товаров, зарегистрированных на сайте Yandex.Market.
+    warehouse_id(str): Идентификатор склада, к которому привязаны остатки.
+
+    Returns:
+    prices(List[dict]): Список цен, как в `create_prices`
+    stocks(List[dict]): Список остатков, как в `create_stocks`
+
+    Exceptions:
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы"""
+    remnants = select_remnants(watch_remnants, offer_ids)
+    prices = _prices_from_remnants(remnants)
+    stocks = _stocks_from_remnants(remnants, offer_ids, warehouse_id)
+    return prices, stocks
+
+
 async def upload_prices(watch_remnants, campaign_id, market_token): 
     """ Загружает цены товаров  путем обновления ценовых предложений. 
     Создает цены на основе полученных остатков и обновляет существующие цены по 500 записей.
 
     Args: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре 
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре 
     campaign_id(str): Идентификатор продавца для получения доступа к своему магазину на сайте Yandex.Market
     market_token(str): Токен аутентификации на Yandex.Market
      
@@ -261,8 +302,7 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных. """
     offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await send_batches(update_price, prices, 500, campaign_id, market_token)
     return prices
 
 
@@ -273,7 +313,7 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
     пакетами по 2000 элементов. 
 
     Args: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре 
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре 
     campaign_id(str): Идентификатор продавца для получения доступа к своему магазину 
     market_token(str): Токен аутентификации на Yandex.Market
     warehouse_id(str): Токен аутентифиуации склада где находится товар
@@ -287,21 +327,52 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных. """
     offer_ids = get_offer_ids(campaign_id, market_token)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
-    )
+    await send_batches(update_stocks, stocks, 2000, campaign_id, market_token)
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
-def main(): 
+async def upload_prices_and_stocks(
+    watch_remnants, campaign_id, market_token, warehouse_id, semaphore=None
+):
+    """Загружает цены и остатки одной кампании. Формирует оба списка через 
+    `create_prices_and_stocks` и отправляет пакеты цен (по 500) и остатков (по 2000) одновременно.
+
+    Args:
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
+    campaign_id(str): Идентификатор продавца для получения доступа к своему магазину на сайте Yandex.Market
+    market_token(str): Токен аутентификации на Yandex.Market
+    warehouse_id(str): Идентификатор склада, к которому привязаны остатки
+    semaphore(asyncio.Semaphore): Ограничитель одновременных запросов к Yandex.Market, 
+    общий для всех кампаний
+
+    Returns:
+    prices(list): Список загруженных цен
+    stocks(list): Список загруженных остатков
+
+    Exceptions:
+    HTTPError: Возникает, если сервер вернул ошибку (код статуса >= 400)"""
+    offer_ids = await asyncio.to_thread(get_offer_ids, campaign_id, market_token)
+    prices, stocks = create_prices_and_stocks(watch_remnants, offer_ids, warehouse_id)
+    await asyncio.gather(
+        send_batches(
+            update_stocks, stocks, 2000, campaign_id, market_token, semaphore=semaphore
+        ),
+        send_batches(
+            update_price, prices, 500, campaign_id, market_token, semaphore=semaphore
+        ),
+    )
+    return prices, stocks
+
+
+async def main(): 
     """ Основная точка входа программы для обновления информации о товарах на Yandex.Market
     Эта функция выполняет полное обновление данных о товарах на сайте Yandex.Market для двух 
     видов ведения продаж на данном сайте('FBS'(Доставка Yandex),'DBS'(Доставка силами продавца)): 
     1.Чтение настроек из переменных окружения. 
     2.Загрузка текущего состояния запасов товаров.
-    3.Обновление остатков и цен для обоих видов ведения деятельности.
+    3.Обновление остатков и цен для обоих видов ведения деятельности. FBS и DBS обновляются 
+    одновременно, не более `MAX_CONCURRENT_REQUESTS` запросов к Yandex.Market за раз.
     4.Отлавливание и обработка возможных ошибок при взаимодействии с API.
 
     Returns: 
@@ -320,30 +391,35 @@ def main():
 
     watch_remnants = download_stock()
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
-        print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # Обновить остатки и цены FBS и DBS
+        await asyncio.gather(
+            upload_prices_and_stocks(
+                watch_remnants,
+                campaign_fbs_id,
+                market_token,
+                warehouse_fbs_id,
+                semaphore,
+            ),
+            upload_prices_and_stocks(
+                watch_remnants,
+                campaign_dbs_id,
+                market_token,
+                warehouse_dbs_id,
+                semaphore,
+            ),
+        )
+    except (
+        requests.exceptions.ReadTimeout,
+        requests.exceptions.ConnectionError,
+    ) as error:
+        if is_read_timeout(error):
+            print("Превышено время ожидания...")
+        else:
+            print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,15 +1,89 @@
+import asyncio
 import io
 import logging.config
-import os
 import re
+import time
 import zipfile
 from environs import Env
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
+try:
+    from itertools import batched
+except ImportError:  # Python < 3.12
+
+    def batched(lst, n):
+        if n < 1:
+            raise ValueError("n must be at least one")
+        return (lst[i : i + n] for i in range(0, len(lst), n))
 
 logger = logging.getLogger(__file__)
 
+RETRIES = Retry(
+    total=5,
+    read=1,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "PUT", "POST"),
+    raise_on_status=False,
+)
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=RETRIES))
+TIMEOUT = (5, 30)
+NON_DIGITS = re.compile(r"[^0-9]")
+OFFER_IDS_TTL = 300
+MAX_CONCURRENT_REQUESTS = 10
+_offer_ids_cache = {}
+
+
+def is_read_timeout(error):
+    """Проверяет, что ошибка запроса вызвана превышением времени ожидания ответа. 
+    После исчерпания повторов `RETRIES` requests сообщает о таймауте чтения как о 
+    `ConnectionError`, поэтому причина ищется и внутри нее.
+
+    Args:
+    error(requests.RequestException): Перехваченная ошибка запроса
+
+    Returns:
+    bool: True, если сервер не ответил за отведенное время"""
+    if isinstance(error, requests.exceptions.ReadTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, ReadTimeoutError)
+
+
+def post_json(url, payload, headers):
+    """Отправляет POST-запрос с телом в формате JSON и разбирает JSON-ответ.
+    Для сериализации используется orjson, если он установлен, иначе стандартный json.
+
+    Args:
+    url(str): Адрес метода API
+    payload(dict): Тело запроса
+    headers(dict): Заголовки запроса (данные авторизации)
+
+    Returns:
+    dict: Разобранный ответ сервера
+
+    Exceptions:
+    HTTPError: Возникает, если сервер вернул ошибку (код статуса >= 400)"""
+    response = _session.post(
+        url,
+        data=json_dumps(payload),
+        headers={**headers, "Content-Type": "application/json"},
+        timeout=TIMEOUT,
+    )
+    response.raise_for_status()
+    return json_loads(response.content)
+
 
 def get_product_list(last_id, client_id, seller_token):
     """Запрашивает список товаров с маркетплейса OZON через API
@@ -39,15 +113,14 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    response_object = post_json(url, payload, headers)
     return response_object.get("result")
 
 
 def get_offer_ids(client_id, seller_token):
     """Запрашивает артикулы всех товаров продавца с маркетплейса OZON через API, и формирует список артикулов
-    
+    Список запоминается на `OFFER_IDS_TTL` секунд: `upload_prices` и `upload_stocks` 
+    для того же продавца получают его без повторных запросов к OZON.
     
     Agrs: 
     client_id(str): Клиентский идентификатор для получения доступа к своему магазину на OZON
@@ -61,19 +134,21 @@ def get_offer_ids(client_id, seller_token):
     
     Пример: 
     offer_ids = ['dfwd1254','zcsefr321'...] """
+    cache_key = (client_id, seller_token)
+    cached = _offer_ids_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < OFFER_IDS_TTL:
+        return list(cached[1])
     last_id = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        offer_ids.extend(product.get("offer_id") for product in some_prod.get("items"))
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if total == len(offer_ids):
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
-    return offer_ids
+    _offer_ids_cache[cache_key] = (time.monotonic(), offer_ids)
+    return list(offer_ids)
 
 
 def update_price(prices: list, client_id, seller_token):
@@ -98,9 +173,7 @@ def update_price(prices: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return post_json(url, payload, headers)
 
 
 def update_stocks(stocks: list, client_id, seller_token):
@@ -125,40 +198,35 @@ def update_stocks(stocks: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return post_json(url, payload, headers)
 
 
 def download_stock():
-    """Скачивает файл ostatki с сайта timeworld.ru, извлекает содержимое архива, читает 
-    файл Excel с 18 строки, преобразует данные в словарь и удаляет Excel файл после обработки
+    """Скачивает файл ostatki с сайта timeworld.ru и читает файл Excel из архива 
+    с 18 строки в таблицу, не сохраняя его на диск
     
     Returns:
-    dict: список словарей, где каждый словарь соответсвует одной записи из файла.
+    pd.DataFrame: таблица, где каждая строка соответсвует одной записи из файла.
     
     Exceptions:
     requests.RequestException: Если возникла ошибка при получении данных с сайта. 
-    FileNotFoundError: Если скачанный файл Excel не обнаружен после распаковки.
+    KeyError: Если файл Excel не обнаружен в скачанном архиве.
     
     Пример: 
-    watch_remnants = [{'Код': 'ABCD1234', 'Название': 'Часы Casio...', 'Количество': '>10'}, ...]   """
+    watch_remnants = pd.DataFrame([{'Код': 'ABCD1234', 'Название': 'Часы Casio...', 'Количество': '>10'}, ...])   """
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    response = _session.get(casio_url, timeout=TIMEOUT)
     response.raise_for_status()
     with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
+        excel_file = io.BytesIO(archive.read("ostatki.xls"))
+    # Создаем таблицу остатков часов:
     watch_remnants = pd.read_excel(
         io=excel_file,
         na_values=None,
         keep_default_na=False,
         header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    )
     return watch_remnants
 
 
@@ -171,7 +239,7 @@ def create_stocks(watch_remnants, offer_ids):
     актикулов, не встречающихся в watch_remnants выставляется остаток 0. 
     
     Agrs: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
     offer_ids(List[str]): Список артикулов товаров, зарегистрированных в Ozon.
     
     Returns:
@@ -180,25 +248,31 @@ def create_stocks(watch_remnants, offer_ids):
     Exceptions: 
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных.   
     ValueError: Если какая-либо запись в `watch_remnants` содержит недопустимые или неполные данные.
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы ('Код' или 'Количество')
     
     Пример: 
     stocks =  [{'offer_id': 'Asdfre3', 'stock': 100}, {'offer_id': 'Xsdfwq3', 'stock': 0}]"""
     # Уберем то, что не загружено в seller
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    remnants = select_remnants(watch_remnants, offer_ids)
+    return _stocks_from_remnants(remnants, offer_ids)
+
+
+def _stocks_from_remnants(remnants, offer_ids):
+    """Формирует остатки из уже отобранных `select_remnants` строк (см. `create_stocks`)."""
+    remnants = remnants.drop_duplicates("Код")
+    counts = stock_column_conversion(remnants["Количество"])
+    matched = remnants["Код"].tolist()
+    stocks = [
+        {"offer_id": code, "stock": stock}
+        for code, stock in zip(matched, counts.tolist())
+    ]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
+    matched = set(matched)
+    stocks.extend(
+        {"offer_id": offer_id, "stock": 0}
+        for offer_id in offer_ids
+        if offer_id not in matched
+    )
     return stocks
 
 
@@ -207,10 +281,10 @@ def create_prices(watch_remnants, offer_ids):
     из переменной `offer_ids`. Проходится по списку товаров(`watch_remnants`), фильтруя только те 
     товары, чей артикул указан в переменой (`offer_ids`). Создается переменная (`price`) которая 
     содержит информацию о цене, валюте. Переводит оригинальную цену в нужный формат с функции 
-    (`price_conversion`) 
+    (`price_column_conversion`) 
     
     Args: 
-    watch_remnants(List[dict]):  Список словарей, каждый из которых содержит информацию о конкретном товаре
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
     offer_ids(List[str]): Список артикулов товаров, зарегистрированных в Ozon.
     
     Returns:
@@ -219,24 +293,70 @@ def create_prices(watch_remnants, offer_ids):
     Exceptions: 
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных.   
     ValueError: Если какая-либо запись в `watch_remnants` содержит недопустимые или неполные данные. 
-    KeyError: Появится, если в словаре из `watch_remnants` отсутствуют обязательные поля ('Код' или 'Цена')
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы ('Код' или 'Цена')
     
     Пример: 
     prices = [{'auto_action_enabled': 'UNKNOWN', 'currency_code': 'RUB', 'offer_id': 'Asdgr3', 'old_price': '0', 'price': '5990'}] """
+    remnants = select_remnants(watch_remnants, offer_ids)
+    return _prices_from_remnants(remnants)
+
+
+def _prices_from_remnants(remnants):
+    """Формирует цены из уже отобранных `select_remnants` строк (см. `create_prices`)."""
+    converted = price_column_conversion(remnants["Цена"])
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
+    for code, price in zip(remnants["Код"].tolist(), converted.tolist()):
+        prices.append(
+            {
                 "auto_action_enabled": "UNKNOWN",
                 "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
+                "offer_id": code,
                 "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
+                "price": price,
             }
-            prices.append(price)
+        )
     return prices
 
 
+def select_remnants(watch_remnants, offer_ids):
+    """Отбирает из таблицы остатков строки, артикулы которых есть в списке `offer_ids`. 
+    Проверка выполняется сразу для всего столбца 'Код', без перебора строк в Python.
+    
+    Args: 
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
+    offer_ids(List[str]): Список артикулов товаров, зарегистрированных на площадке.
+    
+    Returns: 
+    pd.DataFrame: Отобранные строки, столбец 'Код' приведен к строкам
+    
+    Exceptions: 
+    KeyError: Появится, если в таблице `watch_remnants` отсутствует столбец 'Код' """
+    codes = watch_remnants["Код"].astype(str)
+    is_loaded = codes.isin(set(offer_ids))
+    selected = watch_remnants[is_loaded].copy()
+    selected["Код"] = codes[is_loaded]
+    return selected
+
+
+def stock_column_conversion(quantities: pd.Series) -> pd.Series:
+    """Вычисляет остатки для целого столбца 'Количество': если указано >10, выставляется 
+    остаток 100, если указано 1 — остаток 0, в остальных случаях берется точное значение.
+    
+    Args: 
+    quantities(pd.Series): Столбец с количеством товара из файла остатков
+    
+    Returns: 
+    pd.Series: Столбец остатков (целые числа)
+    
+    Exceptions: 
+    ValueError: Если значение количества не является числом
+    
+    Пример: 
+    pd.Series(['>10', '1', 5]) -> pd.Series([100, 0, 5]) """
+    counts = quantities.astype(str).map({">10": 100, "1": 0}).fillna(quantities)
+    return counts.astype(int)
+
+
 def price_conversion(price: str) -> str:
     """Преобразование строки цены в числовой формат избавляясь от ненужных символов,отбрасывая значения после точки. 
     
@@ -249,26 +369,89 @@ def price_conversion(price: str) -> str:
     Пример правильной работы: 5'990.00 руб. -> 5990 
     Пример не правильной работы: 5'990.60 руб. -> 5990
     Пример не правильной работы: 5'990,60 руб. -> 599060 """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return NON_DIGITS.sub("", price.split(".", 1)[0])
+
+
+def price_column_conversion(prices: pd.Series) -> pd.Series:
+    """Преобразует целый столбец цен так же, как `price_conversion`, но одной 
+    векторной операцией pandas вместо вызова функции для каждой строки.
+    
+    Args: 
+    prices(pd.Series): Столбец с исходными значениями цен
+    
+    Returns: 
+    pd.Series: Столбец отформатированных цен (строки из цифр)
+    
+    Пример: 
+    pd.Series(["5'990.00 руб.", "1'200.50 руб."]) -> pd.Series(['5990', '1200']) """
+    integer_part = prices.astype(str).str.split(".", n=1).str[0]
+    return integer_part.str.replace(NON_DIGITS, "", regex=True)
 
 
 def divide(lst: list, n: int):
-    """Разделяет список на фрагменты по `n` элементов. 
+    """Разделяет список на фрагменты по `n` элементов. Фрагменты выдаются по одному,
+    поэтому результат можно перебирать напрямую, не оборачивая в `list()`. 
+    На Python 3.12+ используется `itertools.batched`, реализованный на C.
     
     Args: 
     lst(list): Исходный список подлежащий разделению 
     n(int): Колличество элементов в группе 
     
     Returns: 
-    list: Список который имеет длину (`n`), за исключением последнего фрагмента, который может быть короче
+    Iterator: Фрагменты длиной (`n`), за исключением последнего фрагмента, который может быть короче 
+    (кортежи на Python 3.12+, срезы списка на более старых версиях)
     
     Exceptions: 
-    TypeError: если lst не является списком, (`n`) должно быть положительным числом
+    ValueError: если (`n`) не является положительным числом
     
     Пример: 
-    list([1,2,3,4,5,6],[1,2,3,4,5,6]...)  """
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    divide([1,2,3,4,5], 2) -> (1,2), (3,4), (5,)  """
+    return batched(lst, n)
+
+
+async def send_batches(update, items, n, *args, semaphore=None):
+    """Отправляет список пакетами по `n` элементов, выполняя запросы параллельно. 
+    Одновременно выполняется не больше запросов, чем позволяет `semaphore`.
+
+    Args:
+    update(callable): Функция обновления (`update_price` или `update_stocks`)
+    items(list): Список структурированных данных для отправки
+    n(int): Колличество элементов в пакете
+    *args: Остальные аргументы функции обновления (идентификатор и токен продавца)
+    semaphore(asyncio.Semaphore): Общий ограничитель запросов к площадке. Если не передан, 
+    создается свой на `MAX_CONCURRENT_REQUESTS` запросов
+
+    Returns:
+    list: Ответы сервера для каждого пакета
+
+    Exceptions:
+    HTTPError: Возникает, если сервер вернул ошибку хотя бы на один пакет"""
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def send(batch):
+        async with semaphore:
+            return await asyncio.to_thread(update, batch, *args)
+
+    return await asyncio.gather(*(send(batch) for batch in divide(items, n)))
+
+
+def create_prices_and_stocks(watch_remnants, offer_ids):
+    """Создает цены и остатки за один отбор строк из таблицы остатков: строки с артикулами 
+    из `offer_ids` выбираются один раз, и из них формируются и цены, и остатки.
+
+    Args:
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
+    offer_ids(List[str]): Список артикулов товаров, зарегистрированных в Ozon.
+
+    Returns:
+    prices(List[dict]): Список цен, как в `create_prices`
+    stocks(List[dict]): Список остатков, как в `create_stocks`
+
+    Exceptions:
+    KeyError: Появится, если в таблице `watch_remnants` отсутствуют обязательные столбцы"""
+    remnants = select_remnants(watch_remnants, offer_ids)
+    return _prices_from_remnants(remnants), _stocks_from_remnants(remnants, offer_ids)
 
 
 async def upload_prices(watch_remnants, client_id, seller_token): 
@@ -276,7 +459,7 @@ async def upload_prices(watch_remnants, client_id, seller_token):
     Создает цены на основе полученных остатков и обновляет существующие цены по 1000 записей.
 
     Args: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре 
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре 
     client_id(str): Клиентский идентификатор для получения доступа к своему магазину на OZON
     seller_token(str): Токен аутентификации продавца
      
@@ -288,8 +471,7 @@ async def upload_prices(watch_remnants, client_id, seller_token):
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных."""
     offer_ids = get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await send_batches(update_price, prices, 1000, client_id, seller_token)
     return prices
 
 
@@ -299,7 +481,7 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
     не равен нулю. (`stocks`) полный список всех загруженных объектов. 
 
     Args: 
-    watch_remnants(List[dict]): Список словарей, каждый из которых содержит информацию о конкретном товаре 
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре 
     client_id(str): Клиентский идентификатор для получения доступа к своему магазину на OZON
     seller_token(str): Токен аутентификации продавца
     
@@ -312,20 +494,49 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
     TypeError: Если `watch_remnants` или `offer_ids` имеют неправильный тип данных."""
     offer_ids = get_offer_ids(client_id, seller_token)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await send_batches(update_stocks, stocks, 100, client_id, seller_token)
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
+async def upload_prices_and_stocks(watch_remnants, client_id, seller_token):
+    """Загружает цены и остатки продавца. Оба списка формируются через 
+    `create_prices_and_stocks`, после чего пакеты остатков (по 100) и цен (по 900) 
+    отправляются на OZON одновременно, не более `MAX_CONCURRENT_REQUESTS` запросов за раз.
+
+    Args:
+    watch_remnants(pd.DataFrame): Таблица остатков, каждая строка которой содержит информацию о конкретном товаре
+    client_id(str): Клиентский идентификатор для получения доступа к своему магазину на OZON
+    seller_token(str): Токен аутентификации продавца
+
+    Returns:
+    prices(list): Список загруженных цен
+    stocks(list): Список загруженных остатков
+
+    Exceptions:
+    HTTPError: Возникает, если сервер вернул ошибку (код статуса >= 400)"""
+    offer_ids = await asyncio.to_thread(get_offer_ids, client_id, seller_token)
+    prices, stocks = create_prices_and_stocks(watch_remnants, offer_ids)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    await asyncio.gather(
+        send_batches(
+            update_stocks, stocks, 100, client_id, seller_token, semaphore=semaphore
+        ),
+        send_batches(
+            update_price, prices, 900, client_id, seller_token, semaphore=semaphore
+        ),
+    )
+    return prices, stocks
+
+
 def main(): 
     """ Основная точка входа программы для синхронизации остатков и цен товаров. 
     Эта функция управляет процессом полного обновления данных на маркетплейсе OZON:  
     1. Получает идентификационные данные продавца. 
-    2. Запрашивает идентификаторы предложений (offer_ids). 
-    3. Скачивает текущие остатки товаров (`download_stock()`). 
-    4. Формирует структуры остатков (`create_stocks()`) и цен (`create_prices()`). 
-    5. Обновляет остатки и цены  партиями. Процесс выполняется поэтапно,
+    2. Скачивает текущие остатки товаров (`download_stock()`). 
+    3. Запрашивает идентификаторы предложений (offer_ids) в `upload_prices_and_stocks()`. 
+    4. Отбирает строки остатков один раз и формирует из них остатки и цены (`create_prices_and_stocks()`). 
+    5. Отправляет пакеты остатков и цен одновременно, не более `MAX_CONCURRENT_REQUESTS` запросов за раз.
 
     Returns: 
     None: Функция не возвращает никакого значения. 
@@ -336,20 +547,17 @@ def main():
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
         watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
-        print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
+        # Обновить остатки и цены
+        asyncio.run(upload_prices_and_stocks(watch_remnants, client_id, seller_token))
+    except (
+        requests.exceptions.ReadTimeout,
+        requests.exceptions.ConnectionError,
+    ) as error:
+        if is_read_timeout(error):
+            print("Превышено время ожидания...")
+        else:
+            print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 